@@ -1,14 +1,21 @@
 import csv
-
-def write_manifest(csv_filename, accepted):
-    if not accepted or len(accepted) < 1:
+from collections import ChainMap
+
+def write_manifest(csv_filename, accepted, metadata=None):
+    # accepted may be any iterable, so rows can be written as they arrive;
+    # scene-wide metadata columns are held once and layered over each row
+    # instead of being copied into every subject
+    metadata = metadata or {}
+    subjects = iter(accepted)
+    first = next(subjects, None)
+    if first is None:
         return
 
-    with open(csv_filename, 'w') as csvfile:
+    with open(csv_filename, 'w', newline='') as csvfile:
 
         fieldnames = ['#filename1', '#filename2', '#row', '#column']
 
-        for key in sorted(accepted[0].keys()):
+        for key in sorted(set(first.keys()) | set(metadata.keys())):
             if key == "#reason":
                 continue
 
@@ -19,15 +26,16 @@ def write_manifest(csv_filename, accepted):
 
         writer.writeheader()
 
-        for subject in accepted:
-            writer.writerow(subject)
+        writer.writerow(ChainMap(metadata, first))
+        for subject in subjects:
+            writer.writerow(ChainMap(metadata, subject))
 
 
 def write_rejects(csv_filename, rejects):
     if not rejects or len(rejects) < 1:
         return
 
-    with open(csv_filename, 'w') as csvfile:
+    with open(csv_filename, 'w', newline='') as csvfile:
 
         fieldnames = ['#filename', '#reason', '#row', '#column']
         for key in sorted(rejects[0].keys()):
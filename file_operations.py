@@ -1,4 +1,5 @@
 import logging
+from functools import lru_cache
 from os import path, mkdir, listdir
 from shutil import rmtree, copy
 import tempfile
@@ -8,12 +9,18 @@ def find_scene_name(config):
     # return path.splitext(files[0])[0]
     return config.SCENE_DIR
 
-def accept_tile(filename, config):
-    copy(
-        path.join(config.SCRATCH_PATH, "scene", filename),
-        path.join('output', "{0}_tiles".format(config.SCENE_NAME), config.LABEL, filename)
+# accept_tile runs once per tile, so join the directory prefixes only once
+@lru_cache(maxsize=None)
+def tile_prefixes(scratch_path, scene_name, label):
+    return (
+        path.join(scratch_path, "scene", ""),
+        path.join('output', "{0}_tiles".format(scene_name), label, "")
     )
 
+def accept_tile(filename, config):
+    (source, target) = tile_prefixes(config.SCRATCH_PATH, config.SCENE_NAME, config.LABEL)
+    copy(source + filename, target + filename)
+
 def reject_tile(filename, config):
     copy(
         path.join(config.SCRATCH_PATH, "scene", filename),
@@ -62,20 +69,11 @@ def build_scratch(config):
         mkdir(scratch_path)
 
     logger.info("Building scratch tile directories")
-    mkdir(path.join(scratch_path, "land"))
-    mkdir(path.join(scratch_path, "cloud"))
     mkdir(path.join(scratch_path, "scene"))
 
 def get_files_by_extension(filepath, extension):
-    accum = []
-
-    files = listdir(filepath)
-
-    for filename in files:
-        if filename.endswith(extension):
-            accum.append(filename)
-
-    return accum
+    # listdir only reads directory entries; nothing here stats the files
+    return [filename for filename in listdir(filepath) if filename.endswith(extension)]
 
 def maybe_clean_scratch(config):
     logger = logging.getLogger(config.SCENE_NAME)
@@ -1,8 +1,13 @@
-from __future__ import division
+from functools import lru_cache
 from pyproj import Proj
 
+# every tile of a scene shares one UTM zone, so build its projection once
+@lru_cache(maxsize=None)
+def get_projection(utm_zone):
+    return Proj(proj='utm', zone=utm_zone, ellps='WGS84')
+
 def compute_lat_lon(x, y, utm_zone):
-    p = Proj(proj='utm', zone=utm_zone, ellps='WGS84')
+    p = get_projection(utm_zone)
     lat, lon = p(x, y, inverse=True)
     return [lat, lon]
 
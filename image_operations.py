@@ -1,50 +1,63 @@
 import logging
+from glob import glob
 from os import path
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from subprocess import check_output, call
 
+from pool_operations import managed_pool
+
+# header-only reads: -ping skips decoding pixels, and the plain %w/%h
+# escapes avoid a round trip through the fx expression evaluator
 def get_dimensions(a_file):
     result = check_output([
-        "convert",
+        "identify",
         "-quiet",
-        a_file,
         "-ping",
         "-format",
-        '%[fx:w] %[fx:h]',
-        "info:"
-    ]).split(' ')
+        '%w %h',
+        a_file
+    ], universal_newlines=True).split(' ')
 
     return [int(result[0]), int(result[1])]
 
 def get_height(a_file):
     return int(check_output([
-        "convert",
+        "identify",
         "-quiet",
-        a_file,
         "-ping",
         "-format",
-        '%[fx:h]',
-        "info:"
-    ]))
+        '%h',
+        a_file
+    ], universal_newlines=True))
 
 def get_width(a_file):
     return int(check_output([
-        "convert",
+        "identify",
         "-quiet",
-        a_file,
         "-ping",
         "-format",
-        '%[fx:w]',
-        "info:"
-    ]))
+        '%w',
+        a_file
+    ], universal_newlines=True))
+
+# -crop numbers tiles row-major and keeps a short final tile in each row
+# and column, so both counts round up
+def tiles_per_row(width, grid_size):
+    return -(-width // grid_size)
+
+def tiles_per_column(height, grid_size):
+    return -(-height // grid_size)
+
+def tile_index(filename):
+    return int(filename.split("_")[1].split(".")[0])
 
 def generate_rectangles(tiles, width, grid_size):
     rects = []
-    per_row = width // grid_size + 1
+    per_row = tiles_per_row(width, grid_size)
 
     for elem in tiles:
-        idx = int(elem.split("_")[1].split(".")[0])
-        row = idx // per_row
-        col = idx % per_row
+        [row, col] = divmod(tile_index(elem), per_row)
 
         rects.append("-draw")
         rects.append("rectangle " +
@@ -86,9 +99,7 @@ def prepare_land_mask(config):
         "-composite",
         "-blur",
         config.MASK_BLUR,
-        "-crop",
-        str(config.GRID_SIZE)+"x"+str(config.GRID_SIZE),
-        path.join(config.SCRATCH_PATH, "land", "tile_%04d.png")
+        path.join(config.SCRATCH_PATH, "land.mpc")
     ])
 
 def prepare_cloud_mask(config):
@@ -100,20 +111,35 @@ def prepare_cloud_mask(config):
         config.CLOUD_MASK,
         "-blur",
         config.MASK_BLUR,
-        "-crop",
-        str(config.GRID_SIZE)+"x"+str(config.GRID_SIZE),
-        path.join(config.SCRATCH_PATH, "cloud", "tile_%04d.png")
+        path.join(config.SCRATCH_PATH, "cloud.mpc")
     ])
 
 def get_image_statistics(image):
-    return check_output([
+    return [float(value) for value in check_output([
         "convert",
         "-quiet",
         image,
         "-format",
         "\"%[fx:100*minima] %[fx:100*maxima] %[fx:100*mean] %[fx:100*standard_deviation]\"",
         "info:"
-    ]).strip('"').split(" ")
+    ], universal_newlines=True).strip('"').split(" ")]
+
+def get_tile_statistics(mask, config):
+    # measure every tile of a whole mask in one pass from its memory-mapped
+    # .mpc cache; the crop matches the scene tiling, so the list is indexed
+    # by scene tile number
+    output = check_output([
+        "convert",
+        "-quiet",
+        mask,
+        "-crop",
+        str(config.GRID_SIZE)+"x"+str(config.GRID_SIZE),
+        "-format",
+        "%[fx:100*minima] %[fx:100*maxima] %[fx:100*mean] %[fx:100*standard_deviation]\\n",
+        "info:"
+    ], universal_newlines=True)
+
+    return [[float(value) for value in line.split(" ")] for line in output.splitlines()]
 
 def draw_visualization(land, clouds, water, config):
     args = \
@@ -129,11 +155,49 @@ def draw_visualization(land, clouds, water, config):
 
     call(args)
 
-def clamp_image(source, dest, config, brighten):
+def _clamp_channel_args(source):
+    # a parenthesized group so its settings don't leak into the next band
+    return [
+        "(",
+        "-type",
+        "GrayScale",
+        "-depth",
+        "16",
+        source,
+        "clamp_lut.pgm",
+        "-clut",
+        "-dither",
+        "None",
+        "-colors",
+        "256",
+        "-depth",
+        "8",
+        "-clamp",
+        ")"
+    ]
+
+def clamp_and_assemble(config):
+    # clamp the three source bands and combine them in one convert process,
+    # so the clamped bands never hit the disk as intermediate PNGs
     logger = logging.getLogger(config.SCENE_NAME)
-    logger.info("Clamping file %s", path.basename(source))
-    target = path.join(config.SCRATCH_PATH, dest  + ".png")
-    _clamp_image(source, target, config, False, brighten)
+
+    args = ["convert", "-quiet", "-respect-parentheses"]
+    for source in [config.RED_CHANNEL, config.GREEN_CHANNEL, config.BLUE_CHANNEL]:
+        logger.info("Clamping file %s", path.basename(source))
+        args.extend(_clamp_channel_args(source))
+
+    args.extend([
+        "-set",
+        "colorspace",
+        "sRGB",
+        "-depth",
+        "8",
+        "-combine",
+        path.join(config.SCRATCH_PATH, "render.png")
+    ])
+
+    logger.info("Compositing red, green, and blue images")
+    call(args)
 
 def boost_image(source, config):
     logger = logging.getLogger(config.SCENE_NAME)
@@ -168,46 +232,60 @@ def _clamp_image(source, dest, config, boost, brighten):
 
     call(new_args)
 
-def assemble_image(config):
-    logger = logging.getLogger(config.SCENE_NAME)
-
-    red = config.RED_CHANNEL
-    green = config.GREEN_CHANNEL
-    blue = config.BLUE_CHANNEL
-
-    assemble_args = [
+def prepare_tiles(config):
+    # decode the render once into ImageMagick's memory-mapped pixel cache,
+    # then cut it one strip of GRID_SIZE rows at a time so each strip is
+    # read contiguously
+    scene = path.join(config.SCRATCH_PATH, "render.mpc")
+    call([
         "convert",
         "-quiet",
-        red,
-        # path.join(config.SCRATCH_PATH, "green_final.png"),
-        green,
-        blue,
-        "-set",
-        "colorspace",
-        "sRGB",
-        "-depth",
-        "8",
-        "-combine",
-        path.join(config.SCRATCH_PATH, "render.png")
-    ]
+        path.join(config.SCRATCH_PATH, "render.png"),
+        scene
+    ])
 
-    logger.info("Compositing red, green, and blue images")
-    call(assemble_args)
+    grid_size = config.GRID_SIZE
+    per_row = tiles_per_row(config.width, grid_size)
+    strips = tiles_per_column(config.height, grid_size)
 
-def prepare_tiles(config):
-    call([
+    # the strips already run one per core, so keep each convert from
+    # starting an OpenMP pool of its own
+    commands = [[
         "convert",
         "-quiet",
-        path.join(config.SCRATCH_PATH, "render.png"),
+        "-limit",
+        "thread",
+        "1",
+        scene,
         "-crop",
-        str(config.GRID_SIZE)+"x"+str(config.GRID_SIZE),
+        str(config.width)+"x"+str(grid_size)+"+0+"+str(strip*grid_size),
+        "+repage",
+        "-crop",
+        str(grid_size)+"x"+str(grid_size),
+        "-scene",
+        str(strip*per_row),
         path.join(config.SCRATCH_PATH, "scene", "tile_%04d.png")
-    ])
+    ] for strip in range(strips)]
+
+    # every convert maps the same cache file, so the scene is decoded once
+    # and shared through the page cache; threads only wait on the children
+    with managed_pool(ThreadPool(cpu_count())) as pool:
+        pool.map(call, commands)
 
 def label_all(config):
-    call([
+    # mogrify handles one file at a time, so split the tiles into batches
+    # and run several mogrify processes side by side
+    label = config.LABEL
+    tiles = sorted(glob(path.join('output', "{0}_tiles".format(config.SCENE_NAME), label, "*.png")))
+
+    workers = cpu_count()
+    batch_size = max(1, -(-len(tiles) // (4 * workers)))
+
+    # one mogrify per core already, so keep each to a single thread
+    label_args = [
         'mogrify',
         '-quiet',
+        '-limit', 'thread', '1',
         '-resize', '500x500',
         '-fill', 'black',
         '-gravity', 'south',
@@ -216,8 +294,14 @@ def label_all(config):
         '+repage',
         '-stroke', 'black', '-strokewidth', '1',
         '-undercolor', '#00000020',
-        '-annotate', '-0+10', config.LABEL,
+        '-annotate', '-0+10', label,
         '-stroke', 'none',
         '-fill', 'white',
-        '-annotate', '-0+10', config.LABEL, "output/{0}_tiles/{1}/*.png".format(config.SCENE_NAME, config.LABEL)
-    ])
+        '-annotate', '-0+10', label
+    ]
+    commands = [
+        label_args + tiles[start:start + batch_size]
+        for start in range(0, len(tiles), batch_size)]
+
+    with managed_pool(ThreadPool(workers)) as pool:
+        pool.map(call, commands)
@@ -0,0 +1,11 @@
+from contextlib import contextmanager
+
+@contextmanager
+def managed_pool(pool):
+    # unlike Pool's own context manager, let queued work finish on exit
+    # instead of terminating the workers
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
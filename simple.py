@@ -1,10 +1,12 @@
 from os import path
 from sys import argv
+from multiprocessing import Pool, cpu_count
 import logging
 
 import image_operations as img
 from csv_operations import write_rejects, write_manifest
 
+from pool_operations import managed_pool
 from file_operations import (
     build_output, scratch_exists,
     build_scratch, get_files_by_extension, accept_tile, reject_tile,
@@ -20,7 +22,7 @@ logging.basicConfig(
 # python simple.py --clean --assemble --generate-tiles --reject --manifest --label=Before --annotate --name=20QPD input/foo
 
 def usage():
-    print """
+    print("""
 simple.py (Simple Image Pipeline)
 
 python simple.py [--option] SCENE_DIR
@@ -57,81 +59,60 @@ channel to aid in kelp-spotting.
 
     --cloud-threshhold=XX   Configure cloud detection
     --cloud-sensitivity=XX
-    """
-
+    """)
+
+
+FLAG_OPTIONS = {
+    # --help falls through to usage
+    "--help": [],
+    "-?": [],
+
+    "--full": [
+        "WITHTEMPDIR", "REBUILD", "ASSEMBLE_IMAGE", "SLICE_IMAGE",
+        "GENERATE_MASK_TILES", "REMOVE_LAND", "REMOVE_CLOUDS",
+        "REJECT_TILES", "BUILD_MANIFEST", "VISUALIZE_SORT"],
+
+    "--assemble": ["ASSEMBLE_IMAGE"],
+    "--generate-tiles": ["SLICE_IMAGE"],
+    "--generate": ["ASSEMBLE_IMAGE", "SLICE_IMAGE"],
+
+    "--clean": ["REBUILD"],
+
+    "--sort-tiles": [
+        "GENERATE_MASK_TILES", "REMOVE_LAND", "REMOVE_CLOUDS", "REJECT_TILES"],
+    "--generate-mask": ["GENERATE_MASK_TILES"],
+    "--remove-land": ["REMOVE_LAND"],
+    "--remove-clouds": ["REMOVE_CLOUDS"],
+    "--remove-all": ["REMOVE_CLOUDS", "REMOVE_LAND"],
+    "--visualize": ["VISUALIZE_SORT"],
+    "--reject": ["REJECT_TILES"],
+    "--manifest": ["BUILD_MANIFEST"],
+    "--annotate": ["ANNOTATE"],
+}
+
+VALUE_OPTIONS = {
+    "--grid-size": ("GRID_SIZE", int),
+    "--land-threshhold": ("LAND_THRESHHOLD", int),
+    "--land-sensitivity": ("LAND_SENSITIVITY", int),
+    "--cloud-threshhold": ("CLOUD_THRESHHOLD", int),
+    "--cloud-sensitivity": ("CLOUD_SENSITIVITY", int),
+
+    "--label": ("LABEL", str),
+    "--name": ("SCENE_NAME", str),
+}
 
 def parse_options():
     # note that logger is undefined when this method is active
-    for arg in argv:
-        if arg == "simple.py":
+    for arg in argv[1:]:
+        if arg in FLAG_OPTIONS:
+            for setting in FLAG_OPTIONS[arg]:
+                setattr(config, setting, True)
             continue
 
-        if arg == "--help" or arg == "-?":
-            # do nothing, we'll fall through to usage
-            () #noqa
-
-        elif arg == "--full":
-            config.WITHTEMPDIR = True
-            config.REBUILD = True
-            config.ASSEMBLE_IMAGE = True
-            config.SLICE_IMAGE = True
-            config.GENERATE_MASK_TILES = True
-            config.REMOVE_LAND = True
-            config.REMOVE_CLOUDS = True
-            config.REJECT_TILES = True
-            config.BUILD_MANIFEST = True
-            config.VISUALIZE_SORT = True
-
-        elif arg == "--assemble":
-            config.ASSEMBLE_IMAGE = True
-        elif arg == "--generate-tiles":
-            config.SLICE_IMAGE = True
-        elif arg == "--generate":
-            config.ASSEMBLE_IMAGE = True
-            config.SLICE_IMAGE = True
-
-        elif arg == "--clean":
-            config.REBUILD = True
-
-        elif arg == "--sort-tiles":
-            config.GENERATE_MASK_TILES = True
-            config.REMOVE_LAND = True
-            config.REMOVE_CLOUDS = True
-            config.REJECT_TILES = True
-        elif arg == "--generate-mask":
-            config.GENERATE_MASK_TILES = True
-        elif arg == "--remove-land":
-            config.REMOVE_LAND = True
-        elif arg == "--remove-clouds":
-            config.REMOVE_CLOUDS = True
-        elif arg == "--remove-all":
-            config.REMOVE_CLOUDS = True
-            config.REMOVE_LAND = True
-        elif arg == "--visualize":
-            config.VISUALIZE_SORT = True
-        elif arg == "--reject":
-            config.REJECT_TILES = True
-        elif arg == "--manifest":
-            config.BUILD_MANIFEST = True
-        elif arg == "--annotate":
-            config.ANNOTATE = True
-
-        elif arg.startswith("--grid-size="):
-            config.GRID_SIZE = int(arg.split("=")[1])
-        elif arg.startswith("--land-threshhold="):
-            config.LAND_THRESHHOLD = int(arg.split("=")[1])
-        elif arg.startswith("--land-sensitivity="):
-            config.LAND_SENSITIVITY = int(arg.split("=")[1])
-        elif arg.startswith("--cloud-threshhold="):
-            config.CLOUD_THRESHHOLD = int(arg.split("=")[1])
-        elif arg.startswith("--cloud-sensitivity="):
-            config.CLOUD_SENSITIVITY = int(arg.split("=")[1])
-
-        elif arg.startswith("--label="):
-            config.LABEL = arg.split("=")[1]
-        elif arg.startswith("--name="):
-            config.SCENE_NAME = arg.split("=")[1]
-
+        option = arg.split("=")[0]
+        if "=" in arg and option in VALUE_OPTIONS:
+            [setting, convert] = VALUE_OPTIONS[option]
+            setattr(config, setting, convert(arg.split("=")[1]))
         else:
             config.SCENE_DIR = arg
 
@@ -158,42 +139,56 @@ def generate_mask_tiles():
     # generated_count = len(get_files_by_extension(path.join(config.SCRATCH_PATH, "land"), "png"))
     # logger.info("Generated " + str(generated_count) + " tiles")
 
+RULE_SAMPLE_SIZE = 100
+
+def order_rules(rules, sample):
+    # run the rules that reject the most sampled tiles first so that
+    # all() in apply_rules can stop as early as possible
+    rejections = [
+        sum(1 for statistics in sample if not rule(*statistics))
+        for rule in rules]
+    ranked = sorted(zip(rejections, rules), key=lambda pair: -pair[0])
+    return [rule for (_, rule) in ranked]
+
 def apply_rules(candidates, rejects, subdirectory, rules):
     accum = []
     logger = logging.getLogger(config.SCENE_NAME)
 
     logger.info("Examining " + str(len(candidates)) + " tiles for " + subdirectory)
-    for filename in candidates:
-        done = False
-        statistics = img.get_image_statistics(path.join(
-            config.SCRATCH_PATH,
-            subdirectory,
-            filename))
-        for rule in rules:
-            if not rule(*statistics):
-                rejects.append(filename)
-                done = True
-                break
-        if done:
-            continue
-
-        accum.append(filename)
+    mask_statistics = img.get_tile_statistics(
+        path.join(config.SCRATCH_PATH, subdirectory + ".mpc"), config)
+    statistics = [mask_statistics[img.tile_index(filename)] for filename in candidates]
+    # sample evenly across the scene; the leading tiles are all one band of it
+    sample_step = max(1, len(statistics) // RULE_SAMPLE_SIZE)
+    rules = order_rules(rules, statistics[::sample_step])
+
+    for filename, tile_statistics in zip(candidates, statistics):
+        if all(rule(*tile_statistics) for rule in rules):
+            accum.append(filename)
+        else:
+            rejects.append(filename)
 
     return accum
 
-def index_to_location(filename, width, grid_size):
-    per_row = width // grid_size + 1
-    idx = int(filename.split("_")[1].split(".")[0])
-    row = idx // per_row
-    col = idx % per_row
+def tile_locations(filenames, width, grid_size):
+    per_row = img.tiles_per_row(width, grid_size)
+    return [list(divmod(img.tile_index(filename), per_row)) for filename in filenames]
 
-    return [row, col]
+def tile_dimensions(filename, row, column, config):
+    # only tiles in the last row or column of the crop can be short
+    per_row = img.tiles_per_row(config.width, config.GRID_SIZE)
+    per_column = img.tiles_per_column(config.height, config.GRID_SIZE)
+    if row < per_column - 1 and column < per_row - 1:
+        return [config.GRID_SIZE, config.GRID_SIZE]
 
-def build_dict_for_csv(filename, reason, config):
-    [width, height] = img.get_dimensions(path.join(config.SCRATCH_PATH, "scene", filename))
-    [row, column] = index_to_location(filename, config.width, config.GRID_SIZE)
+    return img.get_dimensions(path.join(config.SCRATCH_PATH, "scene", filename))
 
-    my_dict = {
+def build_dict_for_csv(filename, reason, location, dimensions, config):
+    [row, column] = location
+    [width, height] = dimensions
+
+    my_dict = compute_coordinate_metadata(row, column, width, height, config)
+    my_dict.update({
         '#filename1': 'after_' + filename,
         '#filename2': 'before_' + filename,
         '#reason': reason,
@@ -201,13 +196,20 @@ def build_dict_for_csv(filename, reason, config):
         '#column': column,
         '#width': width,
         '#height': height,
-    }
+    })
+    return my_dict
 
-    coordinate_metadata = compute_coordinate_metadata(row, column, width, height, config)
+def _init_worker(settings):
+    # workers may be spawned rather than forked, in which case they import a
+    # fresh config; copy over everything parse_options and main have set
+    for (name, value) in settings.items():
+        setattr(config, name, value)
 
-    my_dict.update(coordinate_metadata)
-    my_dict.update(config.METADATA)
-    return my_dict
+def _accept_one(tile):
+    [filename, location] = tile
+    accept_tile(filename, config)
+    dimensions = tile_dimensions(filename, location[0], location[1], config)
+    return build_dict_for_csv(filename, "Accepted", location, dimensions, config)
 
 
 def main():
@@ -242,7 +244,6 @@ def main():
     logger.setLevel(logging.INFO)
     logger.info("Processing start")
 
-    accepts = []
     rejects = []
 
     [config.width, config.height] = img.get_dimensions(config.INPUT_FILE)
@@ -263,17 +264,7 @@ def main():
 
     if config.ASSEMBLE_IMAGE:
         logger.info("Processing source data to remove negative pixels")
-        clamp = img.clamp_image
-
-        clamp(config.RED_CHANNEL, "red", config, False)
-        clamp(config.GREEN_CHANNEL, "green", config, False)
-        clamp(config.BLUE_CHANNEL, "blue", config, False)
-
-        config.RED_CHANNEL = path.join(config.SCRATCH_PATH, "red.png")
-        config.GREEN_CHANNEL = path.join(config.SCRATCH_PATH, "green.png")
-        config.BLUE_CHANNEL = path.join(config.SCRATCH_PATH, "blue.png")
-
-        img.assemble_image(config)
+        img.clamp_and_assemble(config)
     else:
         logger.info("Skipping scene generation")
 
@@ -289,15 +280,24 @@ def main():
     if config.REJECT_TILES:
         logger.info("Copying all tiles")
         retained_tiles = get_files_by_extension(path.join(config.SCRATCH_PATH, "scene"), "png")
-        for filename in retained_tiles:
-            accept_tile(filename, config)
-            accepts.append(build_dict_for_csv(filename, "Accepted", config))
-
-    if config.BUILD_MANIFEST:
-        logger.info("Writing manifest")
-        write_manifest(
-            path.join("output", "{0}_tiles".format(config.SCENE_NAME), "manifest.csv"),
-            accepts)
+        chunksize = max(1, len(retained_tiles) // (4 * cpu_count()))
+        tiles = list(zip(
+            retained_tiles,
+            tile_locations(retained_tiles, config.width, config.GRID_SIZE)))
+
+        with managed_pool(Pool(initializer=_init_worker, initargs=(vars(config),))) as pool:
+            # the manifest needs the accepted rows, so it is written while the
+            # workers produce them rather than as a stage of its own
+            if config.BUILD_MANIFEST:
+                logger.info("Writing manifest")
+                write_manifest(
+                    path.join("output", "{0}_tiles".format(config.SCENE_NAME), "manifest.csv"),
+                    pool.imap(_accept_one, tiles, chunksize),
+                    config.METADATA)
+            else:
+                pool.map(_accept_one, tiles, chunksize)
+    elif config.BUILD_MANIFEST:
+        logger.info("Skipping manifest, no tiles were sorted")
 
     if config.ANNOTATE:
         logger.info("Annotating with label {0}".format(config.LABEL))